@@ -0,0 +1,88 @@
+"""Settings and helpers shared by the backend (src/main.py) and the Discord bot."""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from pathlib import Path
+from dotenv import load_dotenv
+
+try:
+    import orjson
+except ImportError:  # optional — needs a Rust toolchain to build on Termux
+    orjson = None
+
+load_dotenv(Path(__file__).resolve().parent.parent / ".env")
+
+
+# ── Logging ──────────────────────────────────────────────────────────────────
+# Records are queued and written by a background thread, so a slow or
+# blocked stdout never stalls the event loop. LOG_LEVEL=WARNING in
+# production skips formatting the per-request debug lines entirely.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+
+def setup_logging(logger: logging.Logger, level: str = LOG_LEVEL):
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(handler)
+    queue_handlers(logger)
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def queue_handlers(logger: logging.Logger):
+    """Move the logger's existing handlers behind a queue and writer thread."""
+    handlers = logger.handlers
+    if not handlers or any(isinstance(h, logging.handlers.QueueHandler) for h in handlers):
+        return
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.handlers = [_PassThroughQueueHandler(log_queue)]
+
+
+class _PassThroughQueueHandler(logging.handlers.QueueHandler):
+    # Enqueue the record untouched: the stock prepare() formats it on the
+    # calling thread (the event loop), and uvicorn's access formatter needs
+    # the original args, which prepare() clears.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# ── JSON ─────────────────────────────────────────────────────────────────────
+# orjson when available, stdlib json otherwise; both produce compact UTF-8.
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+# ── Config ───────────────────────────────────────────────────────────────────
+def _parse_discord_ids(value: str) -> frozenset[int]:
+    ids = set()
+    for discord_id in value.split(","):
+        discord_id = discord_id.strip()
+        if not discord_id:
+            continue
+        if not (discord_id.isascii() and discord_id.isdigit()):
+            raise RuntimeError(
+                f"AUTHORIZED_DISCORD_IDS in .env has a non-numeric entry: {discord_id!r}"
+            )
+        ids.add(int(discord_id))
+    return frozenset(ids)
+
+
+AUTHORIZED_DISCORD_IDS = _parse_discord_ids(os.environ.get("AUTHORIZED_DISCORD_IDS", ""))
@@ -1,20 +1,34 @@
+import asyncio
 import json
+import logging
 import os
-from pathlib import Path
+import time
+from typing import AsyncIterator, Awaitable, Callable
 
 import discord
 import httpx
-from dotenv import load_dotenv
 
-load_dotenv(Path(__file__).resolve().parent.parent / ".env")
+from .config import (
+    AUTHORIZED_DISCORD_IDS,
+    JSON_HEADERS,
+    json_dumps,
+    json_loads,
+    orjson,
+    queue_handlers,
+    setup_logging,
+)
+
+try:
+    import uvloop
+except ImportError:  # optional — not available on Windows
+    uvloop = None
+
+# Child of the backend's "sepher" logger, so it shares its handler when
+# the bot runs in-process; standalone, the __main__ block sets it up.
+log = logging.getLogger("sepher.bot")
 
 TOKEN = os.environ.get("DISCORD_BOT_TOKEN", "").strip()
 SERVER_URL = os.environ.get("SERVER_URL", "http://localhost:8000").rstrip("/")
-AUTHORIZED_DISCORD_IDS = {
-    discord_id.strip()
-    for discord_id in os.environ.get("AUTHORIZED_DISCORD_IDS", "").split(",")
-    if discord_id.strip()
-}
 
 if not TOKEN:
     raise RuntimeError("DISCORD_BOT_TOKEN is missing in .env")
@@ -26,20 +40,77 @@ intents = discord.Intents.default()
 intents.message_content = True
 client = discord.Client(intents=intents)
 DISCORD_MESSAGE_LIMIT = 2000
+# Discord allows 5 edits per 5s on a message; stay at that sustained rate.
+STREAM_EDIT_INTERVAL = 1.0
+# Backend answers faster than this get sent directly, without a placeholder.
+PLACEHOLDER_DELAY = 1.0
+
+# Shared across messages so the connection to the backend stays alive.
+http_client: httpx.AsyncClient | None = None
+# Set by the FastAPI app when it hosts the bot (DISCORD_BOT_IN_PROCESS);
+# messages then go straight to its handle_task instead of over HTTP.
+task_handler: Callable[..., Awaitable[dict]] | None = None
 
 
 @client.event
 async def on_ready():
-    print(f"Bot online as {client.user}")
+    global http_client
+    # on_ready fires again after reconnects; keep the existing pool.
+    if http_client is None and task_handler is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=5, keepalive_expiry=60),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        )
+    log.info("Bot online as %s", client.user)
+
+
+class LazyReply:
+    """
+    Stands in for the bot's reply message: the first edit() sends the reply,
+    later ones edit it. Fast answers then cost one Discord call, not two.
+    """
+
+    def __init__(self, message: discord.Message):
+        self.message = message
+        self.sent: discord.Message | None = None
+        self._lock = asyncio.Lock()
+
+    async def placeholder(self, content: str):
+        async with self._lock:
+            if self.sent is None:
+                self.sent = await self.message.reply(content)
 
+    async def edit(self, content: str):
+        async with self._lock:
+            if self.sent is None:
+                self.sent = await self.message.reply(content)
+            else:
+                await self.sent.edit(content=content)
 
-async def safe_edit(target_message: discord.Message, content: str):
+
+async def safe_edit(target_message: LazyReply, content: str):
     text = (content or "").strip() or "No response"
     if len(text) > DISCORD_MESSAGE_LIMIT:
         text = text[: DISCORD_MESSAGE_LIMIT - 20] + "\n\n[truncated]"
     await target_message.edit(content=text)
 
 
+async def stream_edit(target_message: LazyReply, chunks: AsyncIterator[str]):
+    """Show a streamed reply as it arrives, editing at most once per interval."""
+    text = ""
+    shown = ""
+    last_edit = float("-inf")
+    async for chunk in chunks:
+        text += chunk
+        now = time.monotonic()
+        if now - last_edit >= STREAM_EDIT_INTERVAL and text.strip():
+            await safe_edit(target_message, text)
+            shown = text
+            last_edit = now
+    if text != shown or not shown:
+        await safe_edit(target_message, text)
+
+
 @client.event
 async def on_message(message: discord.Message):
     if message.author == client.user:
@@ -50,7 +121,7 @@ async def on_message(message: discord.Message):
     if message.guild is not None and client.user not in message.mentions:
         return
 
-    if str(message.author.id) not in AUTHORIZED_DISCORD_IDS:
+    if message.author.id not in AUTHORIZED_DISCORD_IDS:
         return
 
     content = message.content
@@ -61,37 +132,98 @@ async def on_message(message: discord.Message):
     if not content:
         return
 
-    processing = await message.reply("Processing...")
-
+    processing = LazyReply(message)
+    task = asyncio.create_task(run_task(processing, message.author.id, content))
     try:
-        async with httpx.AsyncClient(timeout=60) as http:
-            response = await http.post(
-                f"{SERVER_URL}/task",
-                json={
-                    "discord_id": str(message.author.id),
-                    "message": content,
-                },
+        await asyncio.wait_for(asyncio.shield(task), timeout=PLACEHOLDER_DELAY)
+    except asyncio.TimeoutError:
+        await processing.placeholder("Processing...")
+        await task
+
+
+async def post_task(discord_id: int, content: str) -> dict:
+    """
+    Run one message through the backend: in-process when the bot is hosted
+    by the FastAPI app, otherwise via POST /task.
+    """
+    if task_handler is not None:
+        # fastapi is only needed (and only surely installed) in-process.
+        from fastapi import HTTPException
+
+        try:
+            return await task_handler(discord_id, content, stream=True)
+        except HTTPException as exc:
+            # Raise what POST /task would have, so both modes report alike.
+            request = httpx.Request("POST", f"{SERVER_URL}/task")
+            response = httpx.Response(
+                exc.status_code,
+                content=json_dumps({"detail": exc.detail}),
+                request=request,
             )
-            response.raise_for_status()
-            data = response.json()
+            raise httpx.HTTPStatusError(
+                f"{exc.status_code} from in-process /task", request=request, response=response
+            ) from exc
+
+    request = http_client.build_request(
+        "POST",
+        f"{SERVER_URL}/task",
+        headers=JSON_HEADERS,
+        content=json_dumps({
+            "discord_id": str(discord_id),
+            "message": content,
+            "stream": True,
+        }),
+    )
+    response = await http_client.send(request, stream=True)
+    if response.is_success and response.headers.get("content-type", "").startswith("text/plain"):
+        return {"ok": True, "action": "chat", "stream": _iter_text_and_close(response)}
+
+    try:
+        await response.aread()
+    finally:
+        await response.aclose()
+    response.raise_for_status()
+    return json_loads(response.content)
+
+
+async def _iter_text_and_close(response: httpx.Response) -> AsyncIterator[str]:
+    try:
+        async for chunk in response.aiter_text():
+            yield chunk
+    finally:
+        await response.aclose()
+
+
+async def run_task(processing: LazyReply, discord_id: int, content: str):
+    """Send one message to the backend and show the result in `processing`."""
+    try:
+        data = await post_task(discord_id, content)
+
+        # Chat replies arrive as a stream of text while the LLM generates.
+        if "stream" in data:
+            await stream_edit(processing, data["stream"])
+            return
 
         if not data.get("ok"):
-            print(f"DEBUG task response (not ok): {data}")
+            log.debug("task response (not ok): %s", data)
             await safe_edit(processing, f"Server error: {data}")
             return
 
         action = data.get("action")
-        print(f"DEBUG task response action={action!r} payload={data}")
+        log.debug("task response action=%r payload=%s", action, data)
 
         if action == "chat":
             reply = data.get("reply", "")
-            print(f"DEBUG reply: '{reply}'")  # add this temporarily
+            log.debug("reply: %r", reply)
             await safe_edit(processing, reply or "No response")
             return
 
         params = data.get("params", {})
         android = data.get("android_response", {})
-        params_json = json.dumps(params, indent=2, ensure_ascii=True)
+        if orjson:
+            params_json = orjson.dumps(params, option=orjson.OPT_INDENT_2).decode()
+        else:
+            params_json = json.dumps(params, indent=2, ensure_ascii=True)
 
         await safe_edit(
             processing,
@@ -111,5 +243,17 @@ async def on_message(message: discord.Message):
         await safe_edit(processing, f"Error: {exc}")
 
 
+async def main():
+    async with client:
+        await client.start(TOKEN)
+
+
 if __name__ == "__main__":
-    client.run(TOKEN)
+    # Same setup client.run() does, but lets uvloop drive the event loop.
+    discord.utils.setup_logging()
+    queue_handlers(logging.getLogger())  # discord.py's handler is on the root logger
+    setup_logging(logging.getLogger("sepher"))
+    try:
+        (uvloop.run if uvloop else asyncio.run)(main())
+    except KeyboardInterrupt:
+        pass
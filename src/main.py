@@ -1,25 +1,41 @@
 #!/usr/bin/env python3
+import asyncio
+import importlib.util
 import json
+import logging
 import os
 import re
-from pathlib import Path
-from dotenv import load_dotenv
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import AsyncIterator
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import httpx
+import msgspec
+
+from .config import (
+    AUTHORIZED_DISCORD_IDS,
+    JSON_HEADERS,
+    json_dumps,
+    json_loads,
+    queue_handlers,
+    setup_logging,
+)
 
-load_dotenv(Path(__file__).resolve().parent.parent / ".env")
+log = logging.getLogger("sepher")
+setup_logging(log)
 
-app = FastAPI()
 
-# ── Config ───────────────────────────────────────────────────────────────────
-AUTHORIZED_DISCORD_IDS = {
-    discord_id.strip()
-    for discord_id in os.environ.get("AUTHORIZED_DISCORD_IDS", "").split(",")
-    if discord_id.strip()
-}
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return json_dumps(content)
 
+
+# ── Config ───────────────────────────────────────────────────────────────────
 LLAMA_URL         = os.environ.get("LLAMA_URL",         "http://localhost:8080/completion")
+LLAMA_BASE_URL    = LLAMA_URL.rsplit("/completion", 1)[0]
 ANDROID_URL       = os.environ.get("ANDROID_URL",       "http://localhost:8081")
 ANDROID_LOCAL_URL = os.environ.get("ANDROID_LOCAL_URL", "http://192.168.1.x:8081")
 ANDROID_AUTH      = (
@@ -27,48 +43,203 @@ ANDROID_AUTH      = (
     os.environ.get("ANDROID_AUTH_PASS", "changeme"),
 )
 SEPHER_API_KEY    = os.environ.get("SEPHER_API_KEY", "").strip()
+LLAMA_SEED        = int(os.environ.get("LLAMA_SEED", "42"))
+LLAMA_SLOT_ID     = int(os.environ.get("LLAMA_SLOT_ID", "-1"))  # -1: server picks
+# Run the Discord bot inside this process (one worker only) instead of
+# as a separate `python -m src.discord_bot` talking to /task over HTTP.
+DISCORD_BOT_IN_PROCESS = os.environ.get("DISCORD_BOT_IN_PROCESS", "").strip().lower() in {"1", "true", "yes"}
+
+# HTTP/2 multiplexes concurrent requests over one connection where the
+# server speaks it over TLS (ngrok, a TLS proxy in front of llama-server);
+# plain http:// stays HTTP/1.1 on the keep-alive pool. httpx refuses
+# http2=True without the h2 package, so only ask for it when importable.
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+# A reachable phone on the LAN connects in milliseconds; only the connect
+# timeout is short so slow actions (summaries) are not cut off.
+ANDROID_LOCAL_TIMEOUT  = httpx.Timeout(20.0, connect=1.5)
+ANDROID_REMOTE_TIMEOUT = httpx.Timeout(20.0)
+# Seconds the LAN gets before ngrok is raced; 0 races both right away.
+ANDROID_HEDGE_DELAY    = float(os.environ.get("ANDROID_HEDGE_DELAY", "0.2"))
+# Set once on both Android clients rather than rebuilt for every command.
+ANDROID_HEADERS = {**JSON_HEADERS, "Authorization": f"Bearer {SEPHER_API_KEY}"}
+
+LLM_HEALTH_INTERVAL = 5.0  # seconds between background llama-server probes
+
+# ── Prompt prefix ────────────────────────────────────────────────────────────
+# Every llama.cpp call (chat and param extraction) starts with exactly these
+# characters, so with cache_prompt the server reuses the KV cache for them and
+# only prefills the per-request tail. Editing or reordering anything in here
+# invalidates that cache for every request until it warms up again — keep
+# per-request text after PROMPT_PREFIX only.
+SYSTEM_PROMPT = (
+    "You are Sepher, AI Assistant ni Charles, a personal phone assistant. "
+    "Your personality is cool, funky, and confident while staying helpful and clear. "
+    "You can set alarms, send texts, play Spotify, send emails, read notifications, add calendar reminders, add notes, summarize unread text messages, and summarize unread emails. "
+    "If asked who you are or what you do, introduce yourself briefly. "
+    "If asked something you cannot do, say so politely and suggest what you can do instead. "
+    "Keep replies short and friendly. "
+    "Do not use emojis in any response."
+)
+PROMPT_PREFIX = f"### System:\n{SYSTEM_PROMPT}\n\n### User:\n"
+PROMPT_SUFFIX = "\n\n### Assistant:\n"
+
+
+class PromptBody:
+    """
+    A /completion body with everything but the per-request text encoded
+    once. The prompt is PROMPT_PREFIX + text + PROMPT_SUFFIX; a request only
+    JSON-encodes its own text and splices it in (string escaping is per
+    character, so the bytes are the same as encoding the whole body).
+
+    Once the prefix has been tokenized, the prompt is sent as a mixed array
+    [*prefix_ids, "text + suffix"] and llama.cpp skips tokenizing the prefix.
+    """
+
+    def __init__(self, options: dict):
+        self.options = options
+        self.use_prefix_text()
+
+    def use_prefix_text(self):
+        self.head = json_dumps({**self.options, "prompt": PROMPT_PREFIX})[:-2]  # drop '"}'
+        self.tail = json_dumps(PROMPT_SUFFIX)[1:] + b"}"
+
+    def use_prefix_tokens(self, prefix_ids: list[int]):
+        self.head = json_dumps({**self.options, "prompt": [*prefix_ids, ""]})[:-3]  # drop '"]}'
+        self.tail = json_dumps(PROMPT_SUFFIX)[1:] + b"]}"
+
+    def encode(self, text: str) -> bytes:
+        return self.head + json_dumps(text)[1:-1] + self.tail
+
+
+# Sent with every completion so the prefix KV is kept and reused.
+LLAMA_CACHE_OPTIONS = {
+    "cache_prompt": True,
+    "seed":         LLAMA_SEED,
+    **({"id_slot": LLAMA_SLOT_ID} if LLAMA_SLOT_ID >= 0 else {}),
+}
+
+PARAMS_OPTIONS = {
+    "n_predict":      60,
+    "temperature":    0.1,
+    "top_k":          10,
+    "top_p":          0.9,
+    "repeat_penalty": 1.1,
+    "stop":           ["### User:", "\n###", "\n\n", "```"],
+    **LLAMA_CACHE_OPTIONS,
+}
+
+CHAT_OPTIONS = {
+    "n_predict":      120,
+    "temperature":    0.7,
+    "top_k":          40,
+    "top_p":          0.9,
+    "repeat_penalty": 1.1,
+    "stop":           ["### User:", "\n###"],
+    **LLAMA_CACHE_OPTIONS,
+}
+
+# Only the prompt changes between calls, so everything else is encoded once.
+PARAMS_STREAM_BODY = PromptBody({**PARAMS_OPTIONS, "stream": True})
+CHAT_BODY          = PromptBody(CHAT_OPTIONS)
+CHAT_STREAM_BODY   = PromptBody({**CHAT_OPTIONS, "stream": True})
+PROMPT_BODIES      = (PARAMS_STREAM_BODY, CHAT_BODY, CHAT_STREAM_BODY)
 
 # ── Intent patterns ──────────────────────────────────────────────────────────
 # Ordered by specificity — more specific patterns first
 INTENT_PATTERNS = [
     # read_email_summary
-    (re.compile(
-        r"\b(read|summari[sz]e|show)\b.{0,40}\b(email|emails|inbox|gmail|outlook)\b",
-        re.I), "read_email_summary"),
+    (r"\b(read|summari[sz]e|show)\b.{0,40}\b(email|emails|inbox|gmail|outlook)\b",
+     "read_email_summary"),
     # read_text_messages
-    (re.compile(
-        r"\b(read|summari[sz]e|show)\b.{0,40}\b(text|texts|sms|messages)\b",
-        re.I), "read_text_messages"),
+    (r"\b(read|summari[sz]e|show)\b.{0,40}\b(text|texts|sms|messages)\b",
+     "read_text_messages"),
     # add_calendar_reminder
-    (re.compile(
-        r"\b(calendar|reminder|remind me|schedule|event|appointment)\b",
-        re.I), "add_calendar_reminder"),
+    (r"\b(calendar|reminder|remind me|schedule|event|appointment)\b",
+     "add_calendar_reminder"),
     # add_note
-    (re.compile(
-        r"\b(note|notes|notepad|memo|jot|write this down)\b",
-        re.I), "add_note"),
+    (r"\b(note|notes|notepad|memo|jot|write this down)\b",
+     "add_note"),
     # send_sms
-    (re.compile(
-        r"\b(text|sms|tell|say to|msg|message)\b.{0,40}\b\w+\b",
-        re.I), "send_sms"),
+    (r"\b(text|sms|tell|say to|msg|message)\b.{0,40}\b\w+\b",
+     "send_sms"),
     # send_email
-    (re.compile(
-        r"\b(email|e-mail|mail)\b",
-        re.I), "send_email"),
+    (r"\b(email|e-mail|mail)\b",
+     "send_email"),
     # set_alarm
-    (re.compile(
-        r"\b(alarm|wake|remind|reminder)\b",
-        re.I), "set_alarm"),
+    (r"\b(alarm|wake|remind|reminder)\b",
+     "set_alarm"),
     # play_spotify
-    (re.compile(
-        r"\b(play|music|song|spotify|listen|queue|shuffle|track)\b",
-        re.I), "play_spotify"),
+    (r"\b(play|music|song|spotify|listen|queue|shuffle|track)\b",
+     "play_spotify"),
     # get_notifications
-    (re.compile(
-        r"\b(notification|notif|alert|update|miss|inbox|read|check|catch up|show me|what did|anything new|what.s new)\b",
-        re.I), "get_notifications"),
+    (r"\b(notification|notif|alert|update|miss|inbox|read|check|catch up|show me|what did|anything new|what.s new)\b",
+     "get_notifications"),
 ]
 
+# All intents fused into one regex so match_intent is a single C-level call
+# instead of a Python loop over nine searches. Each alternative is a
+# lookahead over the whole message, which keeps INTENT_PATTERNS order as the
+# priority (a plain alternation would pick whichever intent matches earliest
+# in the string instead).
+_INTENT_RE = re.compile(
+    "^(?:" + "|".join(
+        f"(?=[\\s\\S]*?(?P<{action}>{pattern}))" for pattern, action in INTENT_PATTERNS
+    ) + ")",
+    re.I,
+)
+
+# Anchored at both ends: only a bare greeting/help request gets the menu, so
+# "hey, text Sam I'm late" or "help me set an alarm" still reach the intents.
+_GREETING_RE = re.compile(
+    r"^\s*(hi|hello|hey|yo|sup|what can you do|help|capabilities|commands|menu|start)"
+    r"(\s+(there|sepher))?[\s!.?,]*$",
+    re.I,
+)
+
+# Common emoji/pictograph Unicode blocks, stripped from chat replies
+_EMOJI_RE = re.compile(
+    r"[\U0001F300-\U0001FAFF\U00002700-\U000027BF\U0001F1E6-\U0001F1FF\u2600-\u26FF]+"
+)
+
+# Deterministic param extractors for the common phrasings — tried before the LLM
+_TIME_RE = re.compile(
+    r"\b(?:(\d{1,2})(?::([0-5]\d))?\s*([ap])\.?m\b|([01]?\d|2[0-3]):([0-5]\d)\b)",
+    re.I,
+)
+_NOTE_RE = re.compile(r"\bnote\s*[:\-]\s*(.+)", re.I | re.S)
+# Read commands are only taken by regex when the whole message is one of these
+# forms ("read my unread texts", "show 5 messages", "read texts from Sam",
+# "summarize 3 gmail emails"); anything else goes to the LLM.
+_READ_TEXTS_RE = re.compile(
+    r"^\s*(?:read|show|summari[sz]e)(?:\s+me)?(?:\s+(?:my|all|all\s+my))?"
+    r"(?:\s+(?:last|latest))?(?:\s+(?P<count>\d{1,3}))?"
+    r"(?:\s+(?:unread|new))?\s+(?:text\s+messages|texts|messages|sms)"
+    r"(?:\s+from\s+(?P<contact>[^\W\d_]+(?:\s+[^\W\d_]+)?))?[\s.!?]*$",
+    re.I,
+)
+_READ_EMAIL_RE = re.compile(
+    r"^\s*(?:read|show|summari[sz]e)(?:\s+me)?(?:\s+my)?(?:\s+(?:last|latest))?"
+    r"\s+(?P<count>\d{1,3})(?:\s+(?:unread|new))?"
+    r"(?:\s+(?P<provider>gmail|outlook)\s+(?:emails?|mails?)"
+    r"|\s+(?:emails?|mails?)\s+(?:from|on|in)\s+(?P<provider_after>gmail|outlook))[\s.!?]*$",
+    re.I,
+)
+# Words after "from" that are a time or not a name; the LLM sorts those out.
+_NOT_A_CONTACT = frozenset({
+    "today", "yesterday", "tonight", "tomorrow", "morning", "afternoon",
+    "evening", "night", "week", "month", "year", "earlier", "now",
+    "this", "last", "the", "my", "a", "an", "everyone", "anyone",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+})
+# Longer messages carry details the regex forms above cannot capture.
+FAST_MAX_WORDS = 6
+# Only a message that *starts* with "play" is a bare query; "can you play
+# something chill" and friends are left to the LLM.
+_PLAY_RE = re.compile(r"^\s*play\s+(.+?)(?:\s+on\s+spotify)?[\s.!]*$", re.I | re.S)
+# Leftover politeness/filler means the query is not clean; ask the LLM instead.
+_PLAY_FILLER_RE = re.compile(r"\b(spotify|please|pls|for me|thanks?|thank you|right now)\b", re.I)
+
 # Param extraction prompts — short and focused so the model stays on task
 PARAM_PROMPTS = {
     "read_text_messages": (
@@ -139,40 +310,56 @@ Hi! I'm Sepher. Here's what I can do:
 Just tell me what you need!\
 """
 
+CHAT_FALLBACK_REPLY = "Sorry, I didn't understand that. Try saying 'help' to see what I can do."
+
 
 # ── Auth ─────────────────────────────────────────────────────────────────────
-def verify_discord_id(discord_id: str):
-    if discord_id not in AUTHORIZED_DISCORD_IDS:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+def parse_discord_id(value) -> int:
+    """Discord IDs arrive as JSON strings of ASCII digits; anything else is unauthorized."""
+    # bool is an int subclass; int(" 1_23 ") and int("+123") would also pass.
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    raise HTTPException(status_code=401, detail="Unauthorized")
 
 
 # ── Intent matching ───────────────────────────────────────────────────────────
 def match_intent(message: str) -> str | None:
     """Fast regex-based intent detection. Returns action name or None."""
-    for pattern, action in INTENT_PATTERNS:
-        if pattern.search(message):
-            return action
-    return None
+    return _match_intent_cached(normalize_message(message))
+
+
+@lru_cache(maxsize=1024)
+def _match_intent_cached(message: str) -> str | None:
+    match = _INTENT_RE.match(message)
+    return match.lastgroup if match else None
+
+
+def normalize_message(message: str) -> str:
+    """Cache key form of a message: lowercased, whitespace collapsed."""
+    return " ".join(message.lower().split())
 
 
 def is_greeting(message: str) -> bool:
-    pattern = re.compile(
-        r"^\s*(hi|hello|hey|sup|what can you do|help|capabilities|commands|menu|start)\b",
-        re.I,
-    )
-    return bool(pattern.match(message))
+    return bool(_GREETING_RE.match(message))
 
 
 def strip_emojis(text: str) -> str:
-    # Remove common emoji/pictograph Unicode blocks.
-    return re.sub(
-        r"[\U0001F300-\U0001FAFF\U00002700-\U000027BF\U0001F1E6-\U0001F1FF\u2600-\u26FF]+",
-        "",
-        text,
-    ).strip()
+    # Most replies have no emoji; skip building a new string when nothing matches.
+    if not _EMOJI_RE.search(text):
+        return text.strip()
+    return _EMOJI_RE.sub("", text).strip()
 
 
 # ── LLM param extraction ──────────────────────────────────────────────────────
+# LLM-extracted params per (action, message), so repeated commands skip the LLM
+PARAMS_CACHE_TTL = 300  # seconds
+PARAMS_CACHE_MAX = 1024
+_params_cache: dict[tuple[str, str], tuple[float, dict]] = {}
+_params_cache_stats = {"hits": 0, "misses": 0}
+
+
 async def extract_params(action: str, message: str) -> dict:
     """
     Use the LLM only to extract params from the message,
@@ -185,49 +372,219 @@ async def extract_params(action: str, message: str) -> dict:
     if prompt_template is None:
         return {}
 
-    prompt = f"### User:\n{prompt_template.format(message=message)}\n\n### Assistant:\n"
+    params = fast_extract_params(action, message)
+    if params is not None:
+        log.debug("params | action=%s | fast=%s", action, params)
+        return params
+
+    # Case is kept in the key: params carry the user's own text.
+    cache_key = (action, " ".join(message.split()))
+    params = _params_cache_get(cache_key)
+    if params is not None:
+        log.debug("params | action=%s | cached=%s", action, params)
+        return params
+
+    prompt = prompt_template.format(message=message)
 
     try:
-        async with httpx.AsyncClient(timeout=20) as client:
-            response = await client.post(LLAMA_URL, json={
-                "prompt":         prompt,
-                "n_predict":      60,
-                "temperature":    0.1,
-                "top_k":          10,
-                "top_p":          0.9,
-                "repeat_penalty": 1.1,
-                "cache_prompt":   True,
-                "stop":           ["### User:", "\n###", "\n\n", "```"],
-            })
+        # Streamed, so the reply can be used as soon as its JSON object
+        # closes; leaving the block early drops the connection, which makes
+        # llama.cpp stop generating whatever the model would add after it.
+        # The model sometimes wraps the JSON in prose or markdown fences;
+        # the scanner skips those.
+        scanner = JSONObjectScanner()
+        params = None
+        async with app.state.llama.stream(
+            "POST",
+            "/completion",
+            timeout=20,
+            headers=JSON_HEADERS,
+            content=PARAMS_STREAM_BODY.encode(prompt),
+        ) as response:
             response.raise_for_status()
-            payload = response.json()
-
-            raw = (
-                payload.get("content")
-                or payload.get("response")
-                or ""
-            ).strip()
+            async for content in sse_contents(response):
+                params = _first_dict(scanner.feed(content))
+                if params is not None:
+                    break
 
-            print(f"DEBUG params | action={action} | raw={raw!r}")
+        log.debug("params | action=%s | raw=%r", action, scanner.text)
 
-            # strip markdown fences just in case
-            clean = raw.strip("`").strip()
-            if clean.startswith("json"):
-                clean = clean[4:].strip()
+        if params is None:
+            log.debug("params | no JSON object in reply, using fallback")
+            return fallback_extract_params(action=action, message=message)
 
-            return json.loads(clean)
+        _params_cache_put(cache_key, params)
+        return params
 
     except httpx.TimeoutException:
-        print(f"DEBUG params | timeout for action={action}, using fallback")
+        log.warning("params | timeout for action=%s, using fallback", action)
         return fallback_extract_params(action=action, message=message)
     except json.JSONDecodeError:
-        print(f"DEBUG params | JSON parse failed, using fallback")
+        log.debug("params | JSON parse failed, using fallback")
         return fallback_extract_params(action=action, message=message)
     except Exception as e:
-        print(f"DEBUG params | error: {e}, using fallback")
+        log.warning("params | error: %s, using fallback", e)
         return fallback_extract_params(action=action, message=message)
 
 
+def _first_dict(candidates) -> dict | None:
+    """First of the `{...}` slices that parses to a dict, or None."""
+    for candidate in candidates:
+        try:
+            obj = json_loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(obj, dict):
+            return obj
+    return None
+
+
+class JSONObjectScanner:
+    """
+    Finds each top-level balanced `{...}` in text fed piece by piece (e.g.
+    streamed tokens), in one left-to-right pass: feed() yields an object as
+    soon as its closing brace arrives. Braces inside JSON strings are ignored.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._start = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str):
+        self.text += chunk
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                # Quotes only open a string inside an object; prose may have stray ones.
+                self._in_string = self._depth > 0
+            elif ch == "{":
+                if self._depth == 0:
+                    self._start = i
+                self._depth += 1
+            elif ch == "}" and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._pos = i + 1
+                    yield text[self._start:i + 1]
+        self._pos = len(text)
+
+
+def _params_cache_get(key: tuple[str, str]) -> dict | None:
+    entry = _params_cache.get(key)
+    if entry is not None and time.monotonic() - entry[0] < PARAMS_CACHE_TTL:
+        _params_cache_stats["hits"] += 1
+        return dict(entry[1])
+    _params_cache.pop(key, None)
+    _params_cache_stats["misses"] += 1
+    return None
+
+
+def _params_cache_put(key: tuple[str, str], params) -> None:
+    # Empty results are not cached so the next identical message retries the LLM.
+    if not isinstance(params, dict) or not params:
+        return
+    if len(_params_cache) >= PARAMS_CACHE_MAX:
+        _params_cache.pop(next(iter(_params_cache)))
+    _params_cache[key] = (time.monotonic(), dict(params))
+
+
+def fast_extract_params(action: str, message: str) -> dict | None:
+    """
+    Regex-only param extraction for well-formed commands, so they skip the LLM.
+    Returns None when the message needs the LLM.
+    """
+    entry = FAST_EXTRACTORS.get(action)
+    if entry is None:
+        return None
+    extractor, short_only = entry
+    if short_only and len(message.split()) > FAST_MAX_WORDS:
+        return None
+    return extractor(message)
+
+
+def _fast_set_alarm(message: str) -> dict | None:
+    match = _TIME_RE.search(message)
+    if not match:
+        return None
+
+    hour, minute, meridiem, hour_24, minute_24 = match.groups()
+    if hour_24 is not None:
+        hour, minute = int(hour_24), int(minute_24)
+        # Only clearly 24-hour times ("18:30", "07:00"); "6:30 tonight"
+        # could be either, so the LLM reads it in context.
+        if hour < 13 and not hour_24.startswith("0"):
+            return None
+        meridiem = "AM" if hour < 12 else "PM"
+        hour = hour % 12 or 12
+    else:
+        hour, minute = int(hour), int(minute or 0)
+        if not 1 <= hour <= 12:
+            return None
+        meridiem = f"{meridiem.upper()}M"
+
+    return {"time": f"{hour}:{minute:02d} {meridiem}"}
+
+
+def _fast_add_note(message: str) -> dict | None:
+    match = _NOTE_RE.search(message)
+    content = match.group(1).strip() if match else ""
+    return {"content": content} if content else None
+
+
+def _fast_play_spotify(message: str) -> dict | None:
+    match = _PLAY_RE.match(message)
+    query = match.group(1).strip() if match else ""
+    if not query or _PLAY_FILLER_RE.search(query):
+        return None
+    return {"query": query}
+
+
+def _fast_read_text_messages(message: str) -> dict | None:
+    match = _READ_TEXTS_RE.match(message)
+    if not match:
+        return None
+    count, contact = match.group("count"), match.group("contact")
+    if count and contact:
+        return None
+    if contact:
+        if any(word in _NOT_A_CONTACT for word in contact.lower().split()):
+            return None
+        return {"scope": "contact", "count": None, "contact": contact}
+    if count:
+        return {"scope": "count", "count": int(count), "contact": None}
+    return {"scope": "all_unread", "count": None, "contact": None}
+
+
+def _fast_read_email_summary(message: str) -> dict | None:
+    match = _READ_EMAIL_RE.match(message)
+    if not match:
+        return None
+    provider = match.group("provider") or match.group("provider_after")
+    return {"provider": provider.lower(), "count": int(match.group("count"))}
+
+
+# action -> (extractor, only for messages of at most FAST_MAX_WORDS words)
+FAST_EXTRACTORS = {
+    "set_alarm":          (_fast_set_alarm, False),
+    "add_note":           (_fast_add_note, False),
+    "play_spotify":       (_fast_play_spotify, False),
+    "read_text_messages": (_fast_read_text_messages, True),
+    "read_email_summary": (_fast_read_email_summary, True),
+}
+
+
 def fallback_extract_params(action: str, message: str) -> dict:
     """
     Deterministic parser fallback so critical flows do not block on LLM.
@@ -278,127 +635,251 @@ def fallback_extract_params(action: str, message: str) -> dict:
     }
 
 
+# Chat replies per message (whitespace collapsed, case kept as in the prompt).
+# Chat is sampled at temperature 0.7, so a cached reply only equals a fresh one
+# when sampling is reproducible: a fixed LLAMA_SEED and a pinned LLAMA_SLOT_ID,
+# so llama.cpp never batches the request with others (--parallel batching
+# changes the logits). Other setups skip the cache. Entries expire like params.
+CHAT_CACHE_ENABLED = LLAMA_SEED >= 0 and LLAMA_SLOT_ID >= 0
+CHAT_CACHE_TTL = PARAMS_CACHE_TTL
+CHAT_CACHE_MAX = 1024
+_chat_cache: OrderedDict[str, tuple[float, str]] = OrderedDict()
+_chat_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _chat_cache_key(message: str) -> str | None:
+    return " ".join(message.split()) if CHAT_CACHE_ENABLED else None
+
+
+def _chat_cache_get(key: str | None) -> str | None:
+    if key is None:
+        return None
+    entry = _chat_cache.get(key)
+    if entry is None or time.monotonic() - entry[0] >= CHAT_CACHE_TTL:
+        _chat_cache.pop(key, None)
+        _chat_cache_stats["misses"] += 1
+        return None
+    _chat_cache.move_to_end(key)
+    _chat_cache_stats["hits"] += 1
+    return entry[1]
+
+
+def _chat_cache_put(key: str | None, reply: str) -> None:
+    if key is None or not reply:
+        return
+    _chat_cache[key] = (time.monotonic(), reply)
+    _chat_cache.move_to_end(key)
+    if len(_chat_cache) > CHAT_CACHE_MAX:
+        _chat_cache.popitem(last=False)
+
+
 async def query_llm_chat(message: str) -> str:
     """
     For messages that don't match any intent pattern,
     let the LLM respond conversationally.
     """
-    prompt = (
-        "### System:\n"
-        "You are Sepher, AI Assistant ni Charles, a personal phone assistant. "
-        "Your personality is cool, funky, and confident while staying helpful and clear. "
-        "You can set alarms, send texts, play Spotify, send emails, read notifications, add calendar reminders, add notes, summarize unread text messages, and summarize unread emails. "
-        "If asked who you are or what you do, introduce yourself briefly. "
-        "If asked something you cannot do, say so politely and suggest what you can do instead. "
-        "Keep replies short and friendly. "
-        "Do not use emojis in any response.\n\n"
-        f"### User:\n{message}\n\n"
-        "### Assistant:\n"
+    cache_key = _chat_cache_key(message)
+    reply = _chat_cache_get(cache_key)
+    if reply is not None:
+        return reply
+
+    response = await app.state.llama.post(
+        "/completion",
+        timeout=60,
+        headers=JSON_HEADERS,
+        content=CHAT_BODY.encode(message),
     )
+    response.raise_for_status()
+    payload = json_loads(response.content)
+    raw = (payload.get("content") or payload.get("response") or "").strip()
+    reply = strip_emojis(raw)
+    _chat_cache_put(cache_key, reply)
+    return reply
+
 
-    async with httpx.AsyncClient(timeout=60) as client:
-        response = await client.post(LLAMA_URL, json={
-            "prompt":         prompt,
-            "n_predict":      120,
-            "temperature":    0.7,
-            "top_k":          40,
-            "top_p":          0.9,
-            "repeat_penalty": 1.1,
-            "cache_prompt":   True,
-            "stop":           ["### User:", "\n###"],
-        })
+async def stream_llm_chat(message: str) -> AsyncIterator[str]:
+    """
+    Same as query_llm_chat, but yields the reply piece by piece as
+    llama.cpp generates it (SSE), so the caller can show it right away.
+    """
+    async with app.state.llama.stream(
+        "POST",
+        "/completion",
+        timeout=60,
+        headers=JSON_HEADERS,
+        content=CHAT_STREAM_BODY.encode(message),
+    ) as response:
         response.raise_for_status()
-        payload = response.json()
-        raw = (payload.get("content") or payload.get("response") or "").strip()
-        return strip_emojis(raw)
+        async for content in sse_contents(response):
+            text = _EMOJI_RE.sub("", content)
+            if text:
+                yield text
+
+
+async def sse_contents(response: httpx.Response) -> AsyncIterator[str]:
+    """Generated text of each chunk of a streamed llama.cpp completion."""
+    async for line in response.aiter_lines():
+        if not line.startswith("data: "):
+            continue
+        chunk = json_loads(line[len("data: "):])
+        if chunk.get("content"):
+            yield chunk["content"]
+        if chunk.get("stop"):
+            break
+
+
+async def _chat_reply_stream(message: str) -> AsyncIterator[str]:
+    """Body for a streamed /task chat reply; falls back like the JSON path."""
+    cache_key = _chat_cache_key(message)
+    reply = _chat_cache_get(cache_key)
+    if reply is not None:
+        yield reply
+        return
+
+    parts = []
+    try:
+        async for text in stream_llm_chat(message):
+            parts.append(text)
+            yield text
+    except Exception as e:
+        log.warning("chat stream | error: %s", e)
+        if not parts:
+            yield CHAT_FALLBACK_REPLY
+        return
+    # Only a reply that streamed to the end is cached.
+    _chat_cache_put(cache_key, "".join(parts).strip())
 
 
 # ── Android forwarder ─────────────────────────────────────────────────────────
-async def send_to_android(command: dict) -> dict:
-    """Forward command to Sepher Android app via LAN first, then fallback URL."""
-    action_aliases = {
-        "add_note": "create_note",
-        "add_calendar_reminder": "add_calendar",
-        "read_text_messages": "summarize_sms",
-        "read_email_summary": "summarize_email",
-    }
+# Backend action names → the names the Android app expects
+ACTION_ALIASES = {
+    "add_note":              "create_note",
+    "add_calendar_reminder": "add_calendar",
+    "read_text_messages":    "summarize_sms",
+    "read_email_summary":    "summarize_email",
+}
+
 
+async def send_to_android(command: dict) -> dict:
+    """
+    Forward command to Sepher Android app via LAN first, then fallback URL.
+    The fallback is started early if the LAN request cannot be sent quickly.
+    """
     action = command.get("action")
-    normalized_action = action_aliases.get(action, action)
+    normalized_action = ACTION_ALIASES.get(action, action)
     payload = {
         "action": normalized_action,
         "params": command.get("params", {}),
     }
 
-    def build_command_url(base_url: str) -> str:
-        return f"{base_url.rstrip('/')}/command"
+    if not app.state.android:
+        raise RuntimeError("No Android URL configured")
 
-    urls = []
-    if ANDROID_LOCAL_URL.strip():
-        urls.append(("local", build_command_url(ANDROID_LOCAL_URL)))
-    if ANDROID_URL.strip() and ANDROID_URL.strip() != ANDROID_LOCAL_URL.strip():
-        urls.append(("remote", build_command_url(ANDROID_URL)))
+    # Racing requests claim delivery as their headers start going out; one
+    # that finds the command already claimed by another aborts unsent, so a
+    # command racing on two URLs reaches the phone at most once.
+    claim = {"by": None}
+    sent = asyncio.Event()
 
-    last_error = None
-    async with httpx.AsyncClient(timeout=20) as client:
-        for mode, url in urls:
-            try:
-                response = await client.post(
-                    url,
-                    json=payload,
-                    headers={
-                        "Authorization": f"Bearer {SEPHER_API_KEY}",
-                    },
-                )
-                response.raise_for_status()
-                data = response.json()
-                data["_forwarded_via"] = mode
-                data["_forwarded_url"] = url
-                return data
-            except Exception as e:
-                last_error = f"{mode}:{url} -> {e}"
+    def delivery_trace(mode: str):
+        async def trace(event_name: str, info: dict):
+            if not event_name.endswith("send_request_headers.started"):
+                return
+            if claim["by"] not in (None, mode):
+                raise RuntimeError(f"not sent, already delivered via {claim['by']}")
+            claim["by"] = mode
+            sent.set()
 
-    raise RuntimeError(last_error or "No Android URL configured")
+        return trace
 
+    def launch(mode: str, client: httpx.AsyncClient):
+        task = asyncio.create_task(_post_command(client, payload, delivery_trace(mode)))
+        tasks[task] = (mode, _command_url(client))
 
-# ── Routes ────────────────────────────────────────────────────────────────────
-@app.get("/", response_class=PlainTextResponse)
-async def root():
-    return "OK"
+    (mode, client), *fallback = app.state.android
+    tasks = {}
+    launch(mode, client)
 
+    def launch_fallback():
+        launch(*fallback.pop(0))
 
-@app.get("/health", response_class=PlainTextResponse)
-async def health():
+    last_error = None
     try:
-        async with httpx.AsyncClient(timeout=3) as client:
-            r = await client.get(LLAMA_URL.replace("/completion", "/health"))
-            llm_status = "ok" if r.status_code == 200 else "unreachable"
-    except Exception:
-        llm_status = "unreachable"
-    return f"server=ok llm={llm_status}"
+        if fallback:
+            # Give the LAN a head start, then race the fallback only if the
+            # request still has not gone out (phone off the LAN, connect
+            # hanging). Once the phone has the command, a second copy
+            # would run it twice, so from then on only fall back on failure.
+            waiter = asyncio.create_task(sent.wait())
+            await asyncio.wait(
+                {waiter, *tasks},
+                timeout=ANDROID_HEDGE_DELAY,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            waiter.cancel()
+            if not sent.is_set():
+                launch_fallback()
+
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                mode, url = tasks.pop(task)
+                try:
+                    data = task.result()
+                except Exception as e:
+                    last_error = f"{mode}:{url} -> {e}"
+                    continue
+                data["_forwarded_via"] = mode
+                data["_forwarded_url"] = url
+                return data
+            if not tasks and fallback:
+                # Every earlier request has failed, possibly after reaching
+                # the phone (500, read timeout); retrying may run it twice.
+                claim["by"] = None
+                launch_fallback()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    raise RuntimeError(last_error)
+
+
+async def _post_command(client: httpx.AsyncClient, payload: dict, trace) -> dict:
+    """POST one command; `trace` is httpx's trace hook (see send_to_android)."""
+    response = await client.post(
+        "/command",
+        content=json_dumps(payload),
+        extensions={"trace": trace},
+    )
+    response.raise_for_status()
+    return json_loads(response.content)
 
 
-@app.post("/task")
-async def create_task(request: Request):
+def _command_url(client: httpx.AsyncClient) -> str:
+    return str(client.base_url.join("command"))
+
+
+# ── Task handling ─────────────────────────────────────────────────────────────
+async def handle_task(discord_id: int, message: str, stream: bool = False) -> dict:
     """
-    Main entry point called by the Discord bot.
+    Shared by /task and the in-process Discord bot.
 
     Flow:
     1. Greeting?     → return capabilities menu
     2. Regex match?  → extract params via LLM → forward to Android
-    3. No match?     → ask user to clarify
+    3. No match?     → let the LLM reply conversationally
 
-    Body:    { "discord_id": "123", "message": "tell Stefanie I love her" }
-    Returns: { "ok": true, "action": "send_sms", "params": {...}, "android_response": {...} }
+    With stream=True, a chat reply (step 3) comes back as
+    { "ok": true, "action": "chat", "stream": <async iterator of text> }.
     """
-    data = await request.json()
-    verify_discord_id(data.get("discord_id", ""))
+    if discord_id not in AUTHORIZED_DISCORD_IDS:
+        raise HTTPException(status_code=401, detail="Unauthorized")
 
-    message = data.get("message", "").strip()
+    message = message.strip()
     if not message:
         raise HTTPException(status_code=400, detail="message is required")
 
-    print(f"DEBUG task | message={message!r}")
+    log.debug("task | message=%r", message)
 
     # 1. Greeting / help request
     if is_greeting(message):
@@ -409,19 +890,22 @@ async def create_task(request: Request):
 
     if action is None:
         # Fall through to LLM for conversational response
+        if stream:
+            return {"ok": True, "action": "chat", "stream": _chat_reply_stream(message)}
         try:
             llm_reply = await query_llm_chat(message)
         except Exception:
-            llm_reply = "Sorry, I didn't understand that. Try saying 'help' to see what I can do."
+            llm_reply = CHAT_FALLBACK_REPLY
         return {"ok": True, "action": "chat", "reply": llm_reply}
 
-    print(f"DEBUG task | matched action={action}")
+    log.debug("task | matched action=%s", action)
 
-    # 3. Extract params via LLM (focused task — much more reliable)
+    # 3. Extract params: regular commands need no LLM, otherwise ask it
+    #    (focused task — much more reliable)
     params = await extract_params(action, message)
 
     command = {"action": action, "params": params}
-    print(f"DEBUG task | command={command}")
+    log.debug("task | command=%s", command)
 
     # 4. Forward to Android
     try:
@@ -437,6 +921,210 @@ async def create_task(request: Request):
     }
 
 
+# ── Lifecycle ─────────────────────────────────────────────────────────────────
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # uvicorn set up its loggers before importing this module; its access
+    # log writes a line per request, so queue those writes as well.
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        queue_handlers(logging.getLogger(name))
+
+    # One pooled client per upstream host, so each keeps its own warm
+    # keep-alive connections instead of paying a TCP/TLS handshake per
+    # request. Built here rather than at import so each uvicorn worker
+    # gets its own.
+    app.state.llama = httpx.AsyncClient(
+        base_url=LLAMA_BASE_URL,
+        limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=60),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        http2=HTTP2,
+    )
+
+    # LAN first, then ngrok; send_to_android tries them in this order.
+    app.state.android = []
+    if ANDROID_LOCAL_URL.strip():
+        app.state.android.append(("local", httpx.AsyncClient(
+            base_url=ANDROID_LOCAL_URL.strip(),
+            headers=ANDROID_HEADERS,
+            timeout=ANDROID_LOCAL_TIMEOUT,
+        )))
+    if ANDROID_URL.strip() and ANDROID_URL.strip() != ANDROID_LOCAL_URL.strip():
+        app.state.android.append(("remote", httpx.AsyncClient(
+            base_url=ANDROID_URL.strip(),
+            headers=ANDROID_HEADERS,
+            timeout=ANDROID_REMOTE_TIMEOUT,
+            http2=HTTP2,
+        )))
+
+    # /health reports this instead of calling llama-server per request.
+    app.state.llm_health = "unknown"
+    health_probe = asyncio.create_task(probe_llm_health())
+
+    bot_task = None
+    if DISCORD_BOT_IN_PROCESS:
+        # Imported here: the bot module requires DISCORD_BOT_TOKEN at import.
+        from . import discord_bot
+
+        discord_bot.task_handler = handle_task
+        bot_task = asyncio.create_task(discord_bot.main())
+        bot_task.add_done_callback(_report_bot_exit)
+
+    try:
+        yield
+    finally:
+        health_probe.cancel()
+        if bot_task is not None:
+            await discord_bot.client.close()
+            await asyncio.gather(bot_task, return_exceptions=True)
+        await app.state.llama.aclose()
+        for _, client in app.state.android:
+            await client.aclose()
+
+
+async def probe_llm_health():
+    """
+    Refresh app.state.llm_health every LLM_HEALTH_INTERVAL seconds. Each
+    time llama-server becomes reachable (startup, or after a restart that
+    emptied its KV cache) the prompt prefix is prefilled again.
+    """
+    while True:
+        try:
+            r = await app.state.llama.get("/health", timeout=3)
+            status = "ok" if r.status_code == 200 else "unreachable"
+        except Exception:
+            status = "unreachable"
+        if status != app.state.llm_health:
+            log.info("llm health: %s", status)
+            app.state.llm_health = status
+            if status == "ok":
+                await warm_prompt_cache()
+        await asyncio.sleep(LLM_HEALTH_INTERVAL)
+
+
+async def warm_prompt_cache():
+    """
+    Tokenize PROMPT_PREFIX once and prefill it into llama.cpp's KV cache
+    (n_predict 0 evaluates the prompt without generating), so the first
+    real request only pays for its own tail. Best effort: the server may be
+    busy or restarting, and older builds have no /tokenize.
+    """
+    prefix = await tokenize_prompt_prefix()
+    try:
+        response = await app.state.llama.post(
+            "/completion",
+            headers=JSON_HEADERS,
+            content=json_dumps({"prompt": prefix, "n_predict": 0, **LLAMA_CACHE_OPTIONS}),
+        )
+        response.raise_for_status()
+    except Exception as e:
+        log.info("prompt cache warmup skipped: %s", e)
+
+
+async def tokenize_prompt_prefix() -> list[int] | str:
+    """
+    Switch PROMPT_BODIES to sending the prefix as token ids; returns the ids,
+    or PROMPT_PREFIX itself if tokenizing failed (bodies then send text).
+    Redone whenever the server comes back, as a new model means new ids.
+    """
+    try:
+        response = await app.state.llama.post(
+            "/tokenize",
+            headers=JSON_HEADERS,
+            # add_special: a prompt that starts with ids gets no BOS added by
+            # the server, so it has to be part of the ids.
+            content=json_dumps({"content": PROMPT_PREFIX, "add_special": True}),
+        )
+        response.raise_for_status()
+        prefix_ids = json_loads(response.content)["tokens"]
+        if not prefix_ids or not all(isinstance(i, int) for i in prefix_ids):
+            raise ValueError("unexpected /tokenize reply")
+    except Exception as e:
+        log.info("prompt prefix sent as text: %s", e)
+        for body in PROMPT_BODIES:
+            body.use_prefix_text()
+        return PROMPT_PREFIX
+
+    for body in PROMPT_BODIES:
+        body.use_prefix_tokens(prefix_ids)
+    log.info("prompt prefix tokenized: %d tokens", len(prefix_ids))
+    return prefix_ids
+
+
+def _report_bot_exit(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Discord bot stopped: %r", task.exception())
+
+
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
+
+
+# ── Routes ────────────────────────────────────────────────────────────────────
+@app.get("/", response_class=PlainTextResponse)
+async def root():
+    return "OK"
+
+
+@app.get("/health", response_class=PlainTextResponse)
+async def health():
+    return f"server=ok llm={app.state.llm_health}"
+
+
+@app.get("/cache")
+async def cache_stats():
+    """Hit/miss counters for the intent, param and chat caches."""
+    return {
+        "intent": _match_intent_cached.cache_info()._asdict(),
+        "params": {**_params_cache_stats, "size": len(_params_cache)},
+        "chat":   {**_chat_cache_stats, "size": len(_chat_cache), "enabled": CHAT_CACHE_ENABLED},
+    }
+
+
+# Request bodies are decoded and type-checked in one C pass straight from the
+# raw bytes (msgspec), with no intermediate dict. discord_id stays loosely
+# typed so a bad one is still a 401 from parse_discord_id, not a 400.
+class TaskBody(msgspec.Struct):
+    discord_id: str | int | None = None
+    message: str = ""
+    stream: bool = False
+
+
+class CommandBody(msgspec.Struct):
+    discord_id: str | int | None = None
+    action: str | None = None
+    params: dict = {}
+
+
+_TASK_DECODER    = msgspec.json.Decoder(TaskBody)
+_COMMAND_DECODER = msgspec.json.Decoder(CommandBody)
+
+
+async def decode_body(request: Request, decoder: msgspec.json.Decoder):
+    try:
+        return decoder.decode(await request.body())
+    except msgspec.ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"invalid body: {e}") from None
+    except msgspec.DecodeError:
+        raise HTTPException(status_code=400, detail="body must be JSON") from None
+
+
+@app.post("/task")
+async def create_task(request: Request):
+    """
+    Main entry point for the Discord bot when it runs as its own process.
+
+    Body:    { "discord_id": "123", "message": "tell Stefanie I love her" }
+    Returns: { "ok": true, "action": "send_sms", "params": {...}, "android_response": {...} }
+
+    With "stream": true in the body, a chat reply is returned as a
+    text/plain stream of the LLM output instead of JSON.
+    """
+    body = await decode_body(request, _TASK_DECODER)
+    result = await handle_task(parse_discord_id(body.discord_id), body.message, stream=body.stream)
+    if "stream" in result:
+        return StreamingResponse(result["stream"], media_type="text/plain; charset=utf-8")
+    return result
+
+
 @app.post("/command")
 async def raw_command(request: Request):
     """
@@ -445,13 +1133,11 @@ async def raw_command(request: Request):
 
     Body: { "discord_id": "...", "action": "set_alarm", "params": { "time": "7:00 AM" } }
     """
-    data = await request.json()
-    verify_discord_id(data.get("discord_id", ""))
+    body = await decode_body(request, _COMMAND_DECODER)
+    if parse_discord_id(body.discord_id) not in AUTHORIZED_DISCORD_IDS:
+        raise HTTPException(status_code=401, detail="Unauthorized")
 
-    command = {
-        "action": data.get("action"),
-        "params": data.get("params", {}),
-    }
+    command = {"action": body.action, "params": body.params}
     if not command["action"]:
         raise HTTPException(status_code=400, detail="action is required")
 